@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# This program runs on a Linux computer with Python 3, NOT on the EV3 brick.
+# It sweeps the hand-picked timing constants of main.py / 5valves.py over a timing model of the rig,
+# spread over a process pool, and prints a ranked table of faster settings that still respect the safety limits.
+# MIT License: Copyright (c) 2022 Mr Jos for the rest of the code
+
+#####################################################################
+#####################################################################
+##########~~~~~PROGRAM WRITTEN BY JOZUA VAN RAVENHORST~~~~~##########
+##########~~~~~~~QUADRUPLE VALVE CONTROL BY 2 MOTORS~~~~~~~##########
+##########~~~~~~~~~~~~~YOUTUBE CHANNEL: MR JOS~~~~~~~~~~~~~##########
+#####################################################################
+##########~~~~~~~~~~~OFFLINE TIMING CONSTANT TUNER~~~~~~~~~~##########
+#####################################################################
+#####################################################################
+
+import argparse
+import itertools
+import math
+import os
+from collections import namedtuple, Counter
+from functools import partial
+from multiprocessing import Pool
+
+
+##########~~~~~~~~~~RIG LAYOUTS, COPIED FROM THE BRICK PROGRAMS~~~~~~~~~~##########
+LAYOUTS = {
+    4: {"valve_pos": [115, 440, 765, 1090],       "pump_pos": 1415},                  #main.py
+    5: {"valve_pos": [115, 440, 765, 1090, 1415], "pump_pos":  277},                  #5valves.py
+}
+LOCAL_PUMP_OFFSET = 162                                                             #go_to_valve() pumps 162° next to the current valve
+
+
+##########~~~~~~~~~~TIMING MODEL CONSTANTS (MEASURE THESE ON THE RIG)~~~~~~~~~~##########
+COMMAND_OVERHEAD  = 10                                                              #ms lost per run_target() call (firmware loop, start of the move)
+PUMP_SETTLE       = 50                                                              #ms wait(50) after pumping, so the encoder stands still
+AIR_PER_STROKE    = 720                                                             #Degrees of compressor rotation needed to refill the air used by 1 cylinder stroke
+
+
+##########~~~~~~~~~~ALL SETTINGS THAT ARE SWEPT, THE FIRST VALUE IS THE CURRENT ONE IN MAIN.PY~~~~~~~~~~##########    #The ranges go past the safety limits on purpose, so the constraints really filter
+Settings = namedtuple("Settings", [
+    "valve_open_time",                                                              #ms a valve stays open
+    "valve_open_angle",                                                             #Lever angle to open a valve completely
+    "overshoot_out",                                                                #Over center target after extending  (-20 in open_valve)
+    "overshoot_in",                                                                 #Over center target after retracting ( 15 in open_valve)
+    "valve_speed", "valve_accel",                                                   #valve_actuator.control.limits(), the speed is also used in its run_target() calls
+    "carriage_speed", "carriage_accel",                                             #carriage_motor.control.limits(), the speed is also used in its run_target() calls
+    "valve_tolerance",                                                              #valve_actuator.control.target_tolerances() angle
+    "carriage_tolerance",                                                           #carriage_motor.control.target_tolerances() angle
+    "pump_safe", "pump_local",                                                      #Pump lengths in the safe spot, and next to a valve
+])
+SPEED_TOLERANCE = 1000                                                              #deg/s part of target_tolerances(), same for both motors
+
+SWEEP = Settings(
+    valve_open_time    = [400, 350, 300, 250],
+    valve_open_angle   = [50, 48, 45],
+    overshoot_out      = [-20, -15, -10],
+    overshoot_in       = [15, 12, 10],
+    valve_speed        = [900, 1000, 1100],
+    valve_accel        = [3600, 7200, 9000],
+    carriage_speed     = [900, 1000, 1100],
+    carriage_accel     = [3600, 7200, 9000],
+    valve_tolerance    = [2, 5, 8],
+    carriage_tolerance = [10, 5, 15],
+    pump_safe          = [7200, 5760],
+    pump_local         = [1440, 1080, 720, 900],
+)
+
+
+def first_settings(sweep):                                                          #The first value of each swept setting, for SWEEP these are the main.py values
+    return Settings(*[values[0] for values in sweep])
+
+
+BASELINE = first_settings(SWEEP)
+
+
+##########~~~~~~~~~~SAFETY CONSTRAINTS~~~~~~~~~~##########
+Limits = namedtuple("Limits", [
+    "min_stroke_time",                                                              #ms a cylinder needs to extend/retract completely
+    "min_open_angle",                                                               #Smallest lever angle that still opens a valve completely
+    "min_overcenter",                                                               #Smallest over center angle that still puts the lever back in center
+    "flat_margin",                                                                  #Max degrees the actuator may stop away from flat, to pass the valves
+    "max_carriage_offset",                                                          #Max degrees the carriage may stop away from a valve, so the actuator still catches the lever
+    "max_speed", "max_accel",                                                       #Highest motor limits allowed
+    "min_reserve",                                                                  #Lowest air reserve (compressor degrees) allowed during the routine
+])
+DEFAULT_LIMITS = Limits(min_stroke_time=300, min_open_angle=45, min_overcenter=10,
+                        flat_margin=5, max_carriage_offset=10, max_speed=1000, max_accel=7200, min_reserve=2880)
+
+
+##########~~~~~~~~~~ROUTINES, THE SAME STEPS AS THE DEFINITIONS ON THE BRICK~~~~~~~~~~##########
+def preprogrammed(valves):                                                          #Same as preprogrammed() (menu cursor position 0)
+    steps = [("pump", "Safe")]
+    for x in range(valves): steps.append(("valve", x, "Out", True))
+    steps.append(("valve", 2, "In out", True))
+    for x in range(valves): steps.append(("valve", x, "In", False))
+    return steps
+
+
+def sensor_cycle(valves):                                                           #Every color shown once in sensor_control() (menu cursor position 1)
+    steps = [("pump", "Safe")]
+    for x in range(valves):
+        steps.append(("valve", x, "Out", False))
+        steps.append(("valve", x, "In", True))
+    return steps
+
+
+ROUTINES = {"preprogrammed": preprogrammed, "sensor": sensor_cycle}
+
+
+##########~~~~~~~~~~TIMING MODEL~~~~~~~~~~##########
+def move_time(distance, speed, accel, tolerance):                                   #ms for 1 run_target() with a trapezoid speed profile
+    distance = abs(distance)
+    if distance <= tolerance: return COMMAND_OVERHEAD                               #Already inside the tolerance, the move is finished right away
+    peak = min(speed, math.sqrt(distance * accel))                                  #Short moves never reach the full speed
+    seconds = distance / speed + speed / accel if peak == speed else 2 * peak / accel
+    #The move is finished as soon as the motor is inside both tolerances, the last part of the braking is skipped
+    skipped = min(math.sqrt(2 * tolerance / accel), min(SPEED_TOLERANCE, peak) / accel)
+    return (seconds - skipped) * 1000 + COMMAND_OVERHEAD
+
+
+def violations(s, limits):                                                          #Return the reason these settings are unsafe, or None
+    if s.valve_open_time < limits.min_stroke_time: return "stroke time"
+    #The actuator moves end as soon as they are inside the angle tolerance, so the lever can stop that much short
+    if s.valve_open_angle - s.valve_tolerance < limits.min_open_angle: return "open angle"
+    for overshoot in (-s.overshoot_out, s.overshoot_in):                            #Out overshoots negative, In overshoots positive
+        if overshoot - s.valve_tolerance < limits.min_overcenter or overshoot >= s.valve_open_angle: return "over center"
+    if s.valve_tolerance > limits.flat_margin: return "lever flat"
+    if s.carriage_tolerance > limits.max_carriage_offset: return "carriage offset"  #The actuator starts turning before the carriage is completely at the valve
+    if s.pump_safe % 360 or s.pump_local % 360: return "lever flat"                 #Only pump in increments of 360° to keep the actuator flat
+    if max(s.valve_speed, s.carriage_speed) > limits.max_speed: return "speed"
+    if max(s.valve_accel, s.carriage_accel) > limits.max_accel: return "acceleration"
+    return None
+
+
+def run_routine(steps, s, layout):                                                  #Walk through the routine, return (total ms, lowest air reserve)
+    valve_pos = layout["valve_pos"]
+    carriage = valve_pos[0]                                                         #The main program homes and parks at the first valve
+    total = 0.0
+    reserve = 0
+    lowest = float("inf")
+
+    def carriage_to(target):
+        nonlocal carriage, total
+        total += move_time(target - carriage, s.carriage_speed, s.carriage_accel, s.carriage_tolerance)
+        carriage = target
+
+    def actuator(distance):
+        nonlocal total
+        total += move_time(distance, s.valve_speed, s.valve_accel, s.valve_tolerance)
+
+    def pump(length):
+        nonlocal total, reserve
+        actuator(length)
+        total += PUMP_SETTLE
+        reserve += length
+
+    def open_valve(direction):
+        nonlocal total, reserve, lowest
+        overshoot = s.overshoot_out if direction == "Out" else s.overshoot_in
+        actuator(s.valve_open_angle)                                                #Open the valve from center
+        total += s.valve_open_time
+        reserve -= AIR_PER_STROKE
+        lowest = min(lowest, reserve)
+        actuator(s.valve_open_angle + abs(overshoot))                               #Run over center back
+        actuator(overshoot)                                                         #Align back to center
+
+    for step in steps:
+        if step[0] == "pump":
+            carriage_to(layout["pump_pos"])
+            pump(s.pump_safe)
+        else:
+            _, pos, operation, extra_pump = step
+            carriage_to(valve_pos[pos])
+            for direction in operation.split():
+                open_valve(direction.capitalize())
+            if extra_pump:
+                carriage_to(valve_pos[pos] + LOCAL_PUMP_OFFSET)
+                pump(s.pump_local)
+    return total, lowest
+
+
+def score(s, steps, layout, limits):                                                #Worker for the process pool: (total ms or None, settings, reason)
+    total, lowest = run_routine(steps, s, layout)
+    if lowest < limits.min_reserve: return None, s, "air reserve"
+    return total, s, None
+
+
+##########~~~~~~~~~~SWEEP OVER A PROCESS POOL~~~~~~~~~~##########
+def tune(routine="preprogrammed", valves=4, limits=DEFAULT_LIMITS, sweep=SWEEP, jobs=None, chunksize=512):
+    steps = ROUTINES[routine](valves)
+    worker = partial(score, steps=steps, layout=LAYOUTS[valves], limits=limits)
+    safe = []
+    rejected = Counter()
+    for values in itertools.product(*sweep):                                        #The safety checks are cheap, only simulate the safe settings in the pool
+        s = Settings(*values)
+        reason = violations(s, limits)
+        if reason: rejected[reason] += 1
+        else: safe.append(s)
+    results = []
+    with Pool(processes=jobs) as pool:
+        for total, s, reason in pool.imap_unordered(worker, safe, chunksize):
+            if reason: rejected[reason] += 1
+            else: results.append((total, s))
+    results.sort(key=lambda result: result[0])
+    return results, rejected
+
+
+def print_table(results, baseline, top, sweep=SWEEP):                               #Ranked table, gain compared to the first value of each swept setting
+    #Settings at most 10ms slower than a row, that differ from it in only 1 and the same column, are merged into that row
+    #(like 900/1000), so every value shown in that column is a safe setting that hardly changes the time
+    groups = []                                                                     #[first total, first settings, merged column, values of that column]
+    for total, s in results:
+        if len(groups) == top and total - groups[-1][0] > 10: break                 #Nothing can be merged into the shown rows anymore
+        for group in groups:
+            first_total, first, column, values = group
+            different = [i for i, (a, b) in enumerate(zip(first, s)) if a != b]
+            if total - first_total <= 10 and len(different) == 1 and column in (None, different[0]):
+                group[2] = different[0]
+                values.append(s[different[0]])
+                break
+        else:
+            if len(groups) < top: groups.append([total, s, None, []])
+    columns = ["time s", "gain", "count"] + [name for name in Settings._fields]
+    rows = [["{:.2f}".format(baseline / 1000), "base", "1"] + [str(v) for v in first_settings(sweep)]]
+    for total, s, column, values in groups:
+        shown = [str(v) for v in s]
+        if column is not None: shown[column] = "/".join(str(v) for v in sorted([s[column]] + values, key=sweep[column].index))
+        rows.append(["{:.2f}".format(total / 1000), "{:+.1f}%".format((baseline - total) / baseline * 100), str(len(values) + 1)] + shown)
+    widths = [max(len(column), *[len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def print_impact(results, sweep=SWEEP):                                             #Best time for each value of each setting, the biggest spread matters most
+    impact = []
+    for i, name in enumerate(Settings._fields):
+        best = {}
+        for total, s in results:
+            if s[i] not in best: best[s[i]] = total                                 #Results are sorted, so the first one is the fastest
+        impact.append((max(best.values()) - min(best.values()), name, best))
+    print("Impact of each setting (best time in s for each safe value):")
+    for spread, name, best in sorted(impact, reverse=True):
+        print("  {:<20}{:>6.2f} s   {}".format(name, spread / 1000, "  ".join("{}: {:.2f}".format(v, best[v] / 1000) for v in getattr(sweep, name) if v in best)))
+
+
+def positive(text):                                                                 #argparse type for the amount of worker processes
+    value = int(text)
+    if value < 1: raise argparse.ArgumentTypeError("must be 1 or more, not {}".format(value))
+    return value
+
+
+##########~~~~~~~~~~MAIN PROGRAM~~~~~~~~~~##########
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep the valve control timing constants over a timing model of the rig")
+    parser.add_argument("--routine", choices=sorted(ROUTINES), default="preprogrammed")
+    parser.add_argument("--valves", type=int, choices=sorted(LAYOUTS), default=4, help="4 = main.py, 5 = 5valves.py")
+    parser.add_argument("--top", type=int, default=20, help="Amount of rows to show")
+    parser.add_argument("--jobs", type=positive, default=os.cpu_count(), help="Amount of worker processes")
+    for name, default in zip(Limits._fields, DEFAULT_LIMITS):
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=default)
+    args = parser.parse_args()
+
+    limits = Limits(*[getattr(args, name) for name in Limits._fields])
+    baseline, _ = run_routine(ROUTINES[args.routine](args.valves), BASELINE, LAYOUTS[args.valves])
+    results, rejected = tune(args.routine, args.valves, limits, jobs=args.jobs)
+    print("{} routine, {} valves: {} safe settings, rejected: {}".format(
+        args.routine, args.valves, len(results), ", ".join("{} {}".format(count, reason) for reason, count in rejected.most_common()) or "none"))
+    if results:
+        print_table(results, baseline, args.top)
+        print()
+        print_impact(results)
+    else: print("No settings are safe with these limits")